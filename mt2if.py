@@ -1,70 +1,111 @@
 #!/usr/bin/env python3
+import io
 import os
 import re
 import sys
-from copy import deepcopy
+from functools import lru_cache
 
 
 def main(root):
 
-    filters = set()
-
-    for dir, _, files in os.walk(os.path.join(root, 'ImapMail')):
-        if 'msgFilterRules.dat' in files:
-            filters.add((os.path.join(dir, 'msgFilterRules.dat'), dir))
+    imap_mail = os.path.join(root, 'ImapMail')
+    try:
+        filters = list(find_filter_files(imap_mail))
+    except (FileNotFoundError, NotADirectoryError):
+        raise FileNotFoundError(
+            f'No "{imap_mail}" directory, is "{root}" a Thunderbird profile?'
+        ) from None
+    except OSError as e:
+        raise OSError(f'Cannot read "{imap_mail}": {e.strerror}.') from None
 
     rules = {}
     box = set()
 
     for filter_file, dir in filters:
-        base_rule = {'box': os.path.basename(dir), 'actions': []}
-        box.add(base_rule['box'])
-        current_rule = {}
-        with open(filter_file) as f:
+        rule_box = os.path.basename(dir)
+        box.add(rule_box)
+        current_rule = None
+        with open(filter_file, buffering=1 << 20) as f:
             for line in f:
+                if line[0] not in key_starts:  # version, logging, enabled, type...
+                    continue
                 key, val = parse(line)
                 try:
                     if key == 'name':
-                        if (
-                            'name' in current_rule
-                        ):  # a previous rule have been filled already
-                            rules[current_rule['name']] = current_rule
-                        current_rule = deepcopy(base_rule)
-                        current_rule['name'] = val
+                        # registered right away, later records fill it in place
+                        current_rule = rules[val] = Rule(val, rule_box)
 
                     elif key == 'action':  # start a new action
-                        current_rule['actions'].append({'type': val})
+                        current_rule.actions.append(Action(val))
 
                     elif key == 'actionValue':
-                        assert len(current_rule['actions']) >= 1
-                        current_rule['actions'][-1]['value'] = val
+                        assert len(current_rule.actions) >= 1
+                        current_rule.actions[-1].value = val
 
                     elif key == 'condition':
-                        current_rule['condition'] = convert_condition(val)
+                        current_rule.condition = convert_condition(val)
                 except Exception as e:
                     print(key, val)
                     raise e
-        if 'name' in current_rule:
-            rules[current_rule['name']] = current_rule
 
     return dump_rules(rules, box)
 
 
-record = re.compile(r'^(\w+)="(.*)"$')
+class Rule:
+    __slots__ = ('name', 'box', 'condition', 'actions')
+
+    def __init__(self, name, box, condition=None, actions=None):
+        self.name = name
+        self.box = box
+        self.condition = condition
+        self.actions = [] if actions is None else actions
+
+
+class Action:
+    __slots__ = ('type', 'value')
+
+    def __init__(self, type, value=None):
+        self.type = type
+        self.value = value
 
 
-def valid(path):
-    return os.path.isdir(path)
+def find_filter_files(root):
+    '''
+    Yield (path, directory) for every msgFilterRules.dat found under root.
+    Like os.walk, unreadable directories are silently skipped, except for
+    root itself whose errors are propagated.
+    '''
+    stack = [root]
+    while stack:
+        dir = stack.pop()
+        try:
+            entries = os.scandir(dir)
+        except OSError:
+            if dir == root:
+                raise
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name == 'msgFilterRules.dat':
+                    yield entry.path, dir
+
+
+# first letters of the keys main cares about: name, action(Value), condition
+key_starts = frozenset('nac')
 
 
 def parse(line):
     '''
-    Very naive algorithm
+    Very naive algorithm, lines are expected to look like key="value".
     '''
-    m = record.match(line.strip())
-    if not m:
-        raise ValueError(f'Unsupported line format "{line.strip()}".')
-    return m.group(1), m.group(2)
+    line = line.rstrip('\r\n')
+    eq = line.find('="')
+    key = line[:eq]
+    if eq < 0 or not line.endswith('"', eq + 2) or not key.isidentifier():
+        raise ValueError(f'Unsupported line format "{line}".')
+    return key, line[eq + 2:-1]
 
 
 action_params_folder = re.compile(
@@ -75,6 +116,7 @@ action_params_address = re.compile(
 )
 
 
+@lru_cache(maxsize=1024)
 def convert_action_params(value):
     if m := action_params_folder.match(value):
         username, servername, directory = m[1], m[2], m[3]
@@ -85,77 +127,139 @@ def convert_action_params(value):
         raise ValueError(f'Unsupported actionValue "{value}".')
 
 
-and_set_re = re.compile(r'AND \((.*?,.*?,.*?)\)')
-or_set_re = re.compile(r'OR \((.*?,.*?,.*?)\)')
+cond_set_re = re.compile(r'(AND|OR) \((.*?,.*?,.*?)\)')
 
 
 def convert_condition(value):
-    if conds := and_set_re.findall(value):
-        return AndCond(map(parse_cond, conds))
-    elif conds := or_set_re.findall(value):
-        return OrCond(map(parse_cond, conds))
-    else:
-        raise ValueError(f'Unsupported condition format "{value}".')
-
-
+    '''
+    Return the condition tree for value, or None for "match all messages".
+    '''
+    if value == 'ALL':
+        return None
+    # cheap prefix check before running the regex at all
+    if value.startswith(('AND ', 'OR ')) and (matches := cond_set_re.findall(value)):
+        ops = {op for op, _ in matches}
+        conds = (cond for _, cond in matches)
+        if ops == {'AND'}:
+            return ('and', tuple(map(parse_cond, conds)))
+        elif ops == {'OR'}:
+            return ('or', tuple(map(parse_cond, conds)))
+    raise ValueError(f'Unsupported condition format "{value}".')
+
+
+@lru_cache(maxsize=4096)
 def parse_cond(string):
     '''
     Transform thunderbird conditions into imapfilter sets method calls.
+    Results are cached, so the returned conditions must not be mutated.
     '''
     obj, verb, compl = string.split(',')
     if verb == 'contains':
         if obj in {'from', 'subject', 'bcc', 'cc', 'to', 'body'}:
-            return LiteralCond(f'contain_{obj}(\'{compl}\')')
+            return literal(f'contain_{obj}(\'{compl}\')')
         elif obj == 'all addresses':
-            return OrCond(
-                f'contain_{obj}(\'{compl}\')' for obj in ['from', 'to', 'bcc', 'to']
-            )
+            return ('or', tuple(
+                literal(f'contain_{obj}(\'{compl}\')') for obj in ['from', 'to', 'bcc', 'to']
+            ))
+    elif verb == 'begins with':
+        if obj in {'from', 'subject', 'bcc', 'cc', 'to', 'body'}:
+            # Thunderbird ignores case here, like the IMAP SEARCH behind contain_*
+            return literal(f'match_{obj}(\'(?i)^{quote(compl)}\')')
     elif verb == 'is greater than' and obj == 'size':
-        return LiteralCond(f'is_larger({compl})')
+        return literal(f'is_larger({compl})')
     elif verb == 'is less than' and obj == 'size':
-        return LiteralCond(f'is_smaller({compl})')
+        return literal(f'is_smaller({compl})')
 
     # if no return happened earlier throw
     raise ValueError(f'Unimplemented condition transformation "{obj} {verb} {compl}"')
 
 
-class Cond:
-    def __init__(self, conds):
-        self.conds = [cond if isinstance(cond, Cond) else LiteralCond(cond) for cond in conds]
+quote_escapes = {c: '\\\\' + c for c in '[].*?()|^$+{}'}
+# a backslash is escaped once for the regex and both are doubled for Lua
+quote_escapes['\\'] = '\\' * 4
+# these only need escaping for the Lua string literal itself
+quote_escapes["'"] = "\\'"
+quote_escapes['\n'] = '\\n'
+quote_specials = frozenset(quote_escapes)
+quote_table = str.maketrans(quote_escapes)
 
-    def render(self, base, indent=4):
-        if len(self.conds) == 0:
-            return '()'
-        elif len(self.conds) == 1:
-            return self.conds[0].render(base, indent)
-        else:
-            spaces = ' ' * (indent + 4)
-            return '(' + f' {self.sep}\n{spaces}'.join(e.render(base, indent + 4) for e in self.conds) + ')'
 
+def quote(s):
+    '''
+    Escape regex special characters of s for use in imapfilter match_* methods.
+    The pattern ends up in a single quoted Lua string literal, so backslashes
+    are doubled and quotes and newlines are escaped for Lua as well.
+    '''
+    for c in s:
+        if c in quote_specials:
+            return s.translate(quote_table)
+    # most prefixes are plain words, no need to rebuild them
+    return s
 
-class LiteralCond(Cond):
-    def __init__(self, filter):
-        self.filter = filter
 
-    def render(self, base, indent=0):
-        return f'{base}:{self.filter}'
+# Conditions are plain tagged tuples, either ('lit', filter) for a single
+# imapfilter method call or ('and' | 'or', (cond, ...)) to combine them.
+separators = {'and': '*', 'or': '+'}
 
 
-class OrCond(Cond):
-    sep = '+'
+@lru_cache(maxsize=4096)
+def literal(filter):
+    '''
+    Return a shared literal condition for filter, identical filters are only built once.
+    '''
+    return ('lit', filter)
 
 
-class AndCond(Cond):
-    sep = '*'
+def render(cond, base, indent=4, cache=None):
+    '''
+    Render cond as an imapfilter expression on base.
+    The tree is walked iteratively and every subtree is rendered once per
+    (base, indent). Renders are keyed on the subtree itself, so cache may be
+    shared between calls and equal subtrees of different rules are reused.
+    '''
+    if cache is None:
+        cache = {}
+    stack = [(cond, indent, False)]
+    while stack:
+        node, level, children_done = stack.pop()
+        key = (node, base, level)
+        if key in cache:
+            continue
+        kind, value = node
+        if kind == 'lit':
+            cache[key] = f'{base}:{value}'
+        elif len(value) == 0:
+            cache[key] = '()'
+        elif len(value) == 1:
+            if children_done:
+                cache[key] = cache[(value[0], base, level)]
+            else:
+                stack.append((node, level, True))
+                stack.append((value[0], level, False))
+        elif children_done:
+            sep = f' {separators[kind]}\n' + ' ' * (level + 4)
+            cache[key] = f'({sep.join([cache[(e, base, level + 4)] for e in value])})'
+        else:
+            stack.append((node, level, True))
+            stack.extend((e, level + 4, False) for e in value)
+    return cache[(cond, base, indent)]
 
 
 def dump_rules(rules, boxes):
     varnames = {}
-    script = []
-    for servername in boxes:
-        varname = make_unique_varname(servername, boxes)
+    counts = {}
+    script = io.StringIO()
+
+    def emit(chunk):
+        if script.tell():
+            script.write('\n\n')
+        script.write(chunk)
+
+    # sorted so that regenerating the script keeps the same names
+    for servername in sorted(boxes):
+        varname = make_unique_varname(servername, counts)
         varnames[servername] = varname
-        script.append(
+        emit(
             f'{varname} = IMAP {{'
             f'''
     server = '{servername}',
@@ -165,20 +269,38 @@ def dump_rules(rules, boxes):
 }}'''
         )
 
+    actions = {}
+    conds = {}
     for _, rule in rules.items():
         try:
-            script.append(convert_rule(rule, varnames))
+            if converted := convert_rule(rule, varnames, actions, conds):
+                emit(converted)
         except ValueError as e:
             log_error(f'WARNING: {e} Ignoring the corresponding rule.')
             continue
 
-    return '\n\n'.join(script)
+    return script.getvalue()
 
 
-def make_unique_varname(servername, boxes):
-    return '_'.join(
+def make_unique_varname(servername, counts):
+    '''
+    Derive a lua variable name from servername.
+    counts holds every name handed out so far, mapped to the last suffix
+    used with it as a base, so that servers sharing a base name get suffixed
+    names that never clash with another server's name.
+    '''
+    base = '_'.join(
         elem.replace('-', '_') for elem in servername.split('.')[:-1] if elem not in {'imap', 'mail'}
     )
+    n = counts.get(base, 0)
+    while True:
+        n += 1
+        name = base if n == 1 else f'{base}_{n}'
+        if name not in counts:
+            break
+    counts[name] = 1
+    counts[base] = n
+    return name
 
 
 def prefix(elem, bag):
@@ -207,13 +329,28 @@ def cons(a, gen):
     yield from gen
 
 
-def convert_rule(rule, boxes):
-    varname = boxes[rule['box']]
+def convert_rule(rule, boxes, actions=None, conds=None):
+    '''
+    actions optionally caches converted actions across rules, keyed by (type, value).
+    conds optionally caches rendered conditions across rules, see render.
+    '''
+    if not rule.actions:  # nothing to do with the selected messages
+        return ''
+    if actions is None:
+        actions = {}
+    varname = boxes[rule.box]
     inbox = f'{varname}.INBOX'
-    cond = rule['condition'].render(inbox)
-    return '\n'.join(
-        f'msgs = {cond}\nmsgs:{convert_action(boxes, action)}' for action in rule['actions']
-    )
+    if rule.condition is None:
+        cond = f'{inbox}:select_all()'
+    else:
+        cond = render(rule.condition, inbox, cache=conds)
+    calls = []
+    for action in rule.actions:
+        key = (action.type, action.value)
+        if (call := actions.get(key)) is None:
+            call = actions[key] = convert_action(boxes, action)
+        calls.append(call)
+    return f'msgs = {cond}\n' + '\n'.join(f'msgs:{call}' for call in calls)
 
 
 def convert_action(boxes, action):
@@ -235,12 +372,12 @@ def convert_action(boxes, action):
         'Mark read': ('mark_seen()', noop),
     }
 
-    if action['type'] not in functions:
-        raise ValueError(f'Unimplemented action {action["type"]}.')
+    if action.type not in functions:
+        raise ValueError(f'Unimplemented action {action.type}.')
     else:
-        func, formatter = functions[action['type']]
+        func, formatter = functions[action.type]
 
-    params = action.get('value', None)
+    params = action.value
 
     if params:
         return func.format(formatter(convert_action_params(params)))
@@ -255,6 +392,10 @@ def log_error(msg):
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         root = os.path.expanduser(sys.argv[1])
-        print(main(root))
+        try:
+            print(main(root))
+        except OSError as e:
+            log_error(f'ERROR: {e}')
+            sys.exit(1)
     else:
         print('Usage: python3 exportFilter.py <Thunderbird profile path>')